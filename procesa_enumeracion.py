@@ -2,7 +2,6 @@ import pyodbc
 import logging
 import os
 from datetime import datetime
-from collections import defaultdict
 
 SQLSERVER_CONFIG = {
    'driver': 'ODBC Driver 17 for SQL Server',
@@ -39,119 +38,105 @@ def connect_to_database():
     """Establece la conexión con la base de datos SQL Server."""
     try:
         conn_str = ';'.join([f"{k}={v}" for k, v in SQLSERVER_CONFIG.items()])
-        conexion = pyodbc.connect(conn_str)
+        # Sin autocommit: la actualización se confirma una sola vez al final
+        conexion = pyodbc.connect(conn_str, autocommit=False)
         logging.info("Conexión exitosa a SQL Server")
         return conexion
     except pyodbc.Error as e:
         logging.error(f"Error al conectar a la base de datos: {str(e)}")
         return None
 
-def get_file_groups(connection):
+def update_records(connection):
     """
-    Agrupa los archivos por directorio para procesarlos secuencialmente.
-    Solo considera el código de barras C39.
+    Actualiza los números de página, código de examen y prefijo en la base de datos.
+    Todo el cálculo se hace en el servidor con funciones de ventana: cada C39
+    inicia un documento, el código se arrastra a las páginas siguientes y el
+    número de página se reinicia por documento y por directorio.
+    """
+    update_query = """
+    WITH Archivos AS (
+        SELECT
+            Id,
+            Ruta,
+            NULLIF(BarcodeC39, '') AS BarcodeC39,
+            CASE
+                WHEN CHARINDEX('\\', REVERSE(REPLACE(Ruta, '/', '\\'))) > 0
+                THEN LEFT(Ruta, LEN(Ruta) - CHARINDEX('\\', REVERSE(REPLACE(Ruta, '/', '\\'))))
+                ELSE ''
+            END AS Directorio
+        FROM Codificacion
+    ),
+    Directorios AS (
+        SELECT
+            Id,
+            Ruta,
+            BarcodeC39,
+            Directorio,
+            MIN(Ruta) OVER (PARTITION BY Directorio) AS PrimeraRuta
+        FROM Archivos
+    ),
+    Documentos AS (
+        SELECT
+            Id,
+            Ruta,
+            BarcodeC39,
+            Directorio,
+            SUM(CASE WHEN BarcodeC39 IS NOT NULL THEN 1 ELSE 0 END) OVER (
+                ORDER BY PrimeraRuta, Directorio, Ruta
+                ROWS UNBOUNDED PRECEDING
+            ) AS Documento
+        FROM Directorios
+    ),
+    Paginas AS (
+        SELECT
+            Id,
+            ROW_NUMBER() OVER (PARTITION BY Directorio, Documento ORDER BY Ruta) AS NumeroPagina,
+            MAX(BarcodeC39) OVER (PARTITION BY Documento) AS CodigoExamen
+        FROM Documentos
+    )
+    UPDATE c
+    SET NumeroPagina = p.NumeroPagina,
+        CodigoExamen = p.CodigoExamen,
+        Prefijo = LEFT(p.CodigoExamen, 3)
+    FROM Codificacion c
+    INNER JOIN Paginas p ON c.Id = p.Id
     """
-    groups = defaultdict(list)
     
-    query = """
-    SELECT Id, Ruta, BarcodeC39
+    documents_query = """
+    SELECT COUNT(*) AS total_documents
     FROM Codificacion
-    ORDER BY Ruta
+    WHERE BarcodeC39 IS NOT NULL AND BarcodeC39 <> ''
     """
     
     try:
         cursor = connection.cursor()
-        cursor.execute(query)
-        rows = cursor.fetchall()
         
-        for row in rows:
-            directory = os.path.dirname(row.Ruta)
-            groups[directory].append({
-                'id': row.Id,
-                'ruta': row.Ruta,
-                'barcode': row.BarcodeC39,
-                'has_barcode': bool(row.BarcodeC39)
-            })
-            
-        # Ordenar archivos dentro de cada grupo
-        for directory in groups:
-            groups[directory].sort(key=lambda x: x['ruta'])
-            
-        return groups
-    except pyodbc.Error as e:
-        logging.error(f"Error al obtener los grupos de archivos: {str(e)}")
-        return None
-
-def update_records(connection, groups):
-    """
-    Actualiza los números de página, código de examen y prefijo en la base de datos.
-    """
-    update_query = """
-    UPDATE Codificacion
-    SET NumeroPagina = ?,
-        CodigoExamen = ?,
-        Prefijo = ?
-    WHERE Id = ?
-    """
-    
-    try:
-        cursor = connection.cursor()
-        updates = []
-        total_documents = 0
-        current_barcode = None
+        logging.info("Ejecutando actualización masiva en el servidor...")
+        cursor.execute(update_query)
+        updated_count = cursor.rowcount
         
-        # Procesar cada grupo de archivos
-        for directory, files in groups.items():
-            current_page = 1
-            logging.info(f"Procesando directorio: {directory}")
-            
-            for file in files:
-                # Si encuentra un C39, actualiza el código actual y reinicia el contador
-                if file['has_barcode']:
-                    current_page = 1
-                    current_barcode = file['barcode']
-                    total_documents += 1
-                    logging.info(f"Nuevo documento encontrado - Barcode C39: {current_barcode}")
-                
-                # Obtener código de examen y prefijo
-                codigo_examen = current_barcode if current_barcode else None
-                prefijo = codigo_examen[:3] if codigo_examen else None
-                
-                updates.append((
-                    current_page,           # NumeroPagina
-                    codigo_examen,          # CodigoExamen
-                    prefijo,                # Prefijo
-                    file['id']             # Id para WHERE
-                ))
-                
-                logging.debug(f"Preparando actualización - ID: {file['id']}, Página: {current_page}, "
-                            f"Código: {codigo_examen}, Prefijo: {prefijo}")
-                
-                current_page += 1
+        cursor.execute(documents_query)
+        total_documents = cursor.fetchone().total_documents
         
-        # Ejecutar las actualizaciones en lotes
-        logging.info(f"Ejecutando actualización masiva de {len(updates)} registros...")
-        cursor.executemany(update_query, updates)
         connection.commit()
         logging.info("Actualización completada exitosamente")
         
-        return len(updates), total_documents
+        return updated_count, total_documents
     except pyodbc.Error as e:
         logging.error(f"Error al actualizar los registros: {str(e)}")
         connection.rollback()
         return 0, 0
 
-def verify_updates(connection):
+def verify_updates(connection, updated_count):
     """
     Verifica que las actualizaciones se realizaron correctamente.
+    El total actualizado viene del rowcount del UPDATE; aquí solo se cuentan
+    los registros que quedaron sin número de página (idealmente ninguno).
     """
     verification_query = """
-    SELECT 
-        COUNT(*) as total_records,
-        COUNT(NumeroPagina) as pages_updated,
-        COUNT(CodigoExamen) as exam_codes_updated,
-        COUNT(Prefijo) as prefixes_updated
-    FROM Codificacion
+    SELECT COUNT_BIG(*) as pages_missing
+    FROM Codificacion WITH (NOLOCK)
+    WHERE NumeroPagina IS NULL
     """
     
     try:
@@ -160,10 +145,10 @@ def verify_updates(connection):
         result = cursor.fetchone()
         
         logging.info("Resumen de verificación:")
-        logging.info(f"- Total de registros: {result.total_records}")
-        logging.info(f"- Registros con número de página: {result.pages_updated}")
-        logging.info(f"- Registros con código de examen: {result.exam_codes_updated}")
-        logging.info(f"- Registros con prefijo: {result.prefixes_updated}")
+        logging.info(f"- Registros actualizados: {updated_count}")
+        logging.info(f"- Registros sin número de página: {result.pages_missing}")
+        if result.pages_missing:
+            logging.warning("Quedaron registros sin número de página")
         
         return result
     except pyodbc.Error as e:
@@ -183,20 +168,13 @@ def main():
         return
     
     try:
-        # Obtener grupos de archivos
-        logger.info("Obteniendo grupos de archivos...")
-        groups = get_file_groups(connection)
-        if not groups:
-            logger.error("No se pudieron obtener los grupos de archivos")
-            return
-        
         # Actualizar registros
         logger.info("Actualizando registros...")
-        updated_count, total_docs = update_records(connection, groups)
+        updated_count, total_docs = update_records(connection)
         
         # Verificar actualizaciones
         logger.info("Verificando actualizaciones...")
-        verify_updates(connection)
+        verify_updates(connection, updated_count)
         
         logger.info("Resumen final:")
         logger.info(f"- Total de registros actualizados: {updated_count}")
@@ -1,13 +1,22 @@
 import os
+import struct
 import cv2
 import numpy as np
 import pyodbc
 import logging
+import atexit
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener
 from datetime import datetime
 from PIL import Image
 import traceback
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
 import shutil
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from collections import deque, namedtuple
+from itertools import groupby
+from operator import attrgetter
 
 # Configuración de la base de datos
 SQLSERVER_CONFIG = {
@@ -19,6 +28,37 @@ SQLSERVER_CONFIG = {
    'TrustServerCertificate': 'yes'
 }
 
+# Etiquetas TIFF de resolución
+TIFF_TAG_XRESOLUTION = 282
+TIFF_TAG_YRESOLUTION = 283
+TIFF_TAG_RESOLUTION_UNIT = 296
+
+# Pooling del administrador de controladores ODBC (debe fijarse antes de conectar)
+pyodbc.pooling = True
+
+# Cantidad de filas que se traen del servidor en cada lote (cursor.arraysize)
+FETCH_BATCH_SIZE = 5000
+
+# Hilos de procesamiento (cv2 libera el GIL al decodificar y codificar)
+MAX_WORKERS = os.cpu_count() or 1
+
+# Capacidad de la cola de archivos leídos pendientes de decodificar
+PIPELINE_QUEUE_SIZE = 16
+
+# Lecturas de imágenes de origen lanzadas en paralelo por adelantado
+READ_AHEAD = 4
+
+# Cantidad de rutas de recorte que se actualizan en BD por lote
+DB_BATCH_SIZE = 500
+
+# Reemplazo de caracteres especiales en rutas, aplicado en una sola pasada
+PATH_TRANSLATION = str.maketrans({
+    'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u',
+    'Á': 'A', 'É': 'E', 'Í': 'I', 'Ó': 'O', 'Ú': 'U',
+    'ñ': 'n', 'Ñ': 'N',
+    ' ': '_'
+})
+
 class RecortesProcessor:
     def __init__(self, sql_config: Dict, output_directory: str):
         """
@@ -33,6 +73,18 @@ class RecortesProcessor:
         self.connection_string = self._build_connection_string()
         self.setup_logging()
         self._create_directories()
+        self._normalized_output_directory = self.normalize_path(output_directory)
+        
+        # Conexión persistente para las actualizaciones, confirmadas por lote
+        self._conn = pyodbc.connect(self.connection_string, autocommit=False)
+        # Opciones de sesión en un solo lote; NOCOUNT evita un mensaje DONE por UPDATE
+        with self._conn.cursor() as cursor:
+            cursor.execute("SET NOCOUNT ON; SET ARITHABORT ON; SET ANSI_WARNINGS ON;")
+        self._pending = []
+        self._db_errors = 0
+        
+        # Directorios de salida ya creados
+        self._mkdir_cache: Set[str] = set()
 
     def _build_connection_string(self) -> str:
         """Construye el string de conexión a partir de la configuración"""
@@ -66,64 +118,96 @@ class RecortesProcessor:
                 parts = [p for p in path.split('\\') if p]  # Eliminar elementos vacíos
                 path = '\\\\' + '\\'.join(parts[1:])
                 
-            # Expandir el reemplazo de caracteres especiales
-            replacements = {
-                'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u',
-                'Á': 'A', 'É': 'E', 'Í': 'I', 'Ó': 'O', 'Ú': 'U',
-                'ñ': 'n', 'Ñ': 'N',
-                ' ': '_'
-            }
-            for old, new in replacements.items():
-                path = path.replace(old, new)
+            # Reemplazar caracteres especiales
+            path = path.translate(PATH_TRANSLATION)
                 
             return path
         except Exception as e:
             self.logger.error(f"Error normalizando ruta {path}: {str(e)}")
             return path
     
-    def create_hierarchical_directories(self, record: Dict) -> str:
+    def create_hierarchical_directories(self, record: NamedTuple) -> str:
         """
         Crea la estructura jerárquica de directorios y retorna la ruta completa
         """
         try:
             # Normalizar los componentes individuales
-            operativo = self.normalize_path(record['Operativo'])
-            area = self.normalize_path(record['Area'])
-            cod_item = self.normalize_path(record['cod_item'])
-            nombre_archivo = self.normalize_path(record['NombreArchivo'])
-            
-            # Crear la estructura de directorios
-            dir_path = os.path.join(
-                self.normalize_path(self.output_directory),
+            operativo = self.normalize_path(record.Operativo)
+            area = self.normalize_path(record.Area)
+            cod_item = self.normalize_path(record.cod_item)
+            nombre_archivo = self.normalize_path(record.NombreArchivo)
+            
+            # Construir y normalizar (una sola vez) la ruta completa del archivo
+            full_path = self.normalize_path(os.path.join(
+                self._normalized_output_directory,
                 operativo,
                 area,
-                cod_item
-            )
-            
-            # Normalizar la ruta completa
-            dir_path = self.normalize_path(dir_path)
+                cod_item,
+                nombre_archivo
+            ))
             
-            # Crear directorios
-            os.makedirs(dir_path, exist_ok=True)
-            
-            # Construir y normalizar la ruta completa del archivo
-            full_path = self.normalize_path(os.path.join(dir_path, nombre_archivo))
+            # Crear directorios y verificar permisos (solo la primera vez que aparece cada uno)
+            dir_path = os.path.dirname(full_path)
+            if dir_path not in self._mkdir_cache:
+                try:
+                    os.makedirs(dir_path, exist_ok=True)
+                except Exception as e:
+                    raise ValueError(f"No se pueden crear/acceder los directorios: {str(e)}")
+                if not os.access(dir_path, os.W_OK):
+                    self.logger.warning(f"Sin permisos de escritura en directorio: {dir_path}")
+                self._mkdir_cache.add(dir_path)
             
-            self.logger.info(f"Ruta normalizada creada: {full_path}")
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(f"Ruta normalizada creada: {full_path}")
             return full_path
             
         except Exception as e:
             self.logger.error(f"Error creando directorios: {str(e)}")
             raise
 
-    def update_recorte_path(self, record: Dict, full_path: str):
+    def close(self):
+        """Envía las actualizaciones pendientes y cierra la conexión persistente"""
+        try:
+            self._flush_pending_updates()
+        finally:
+            self._conn.close()
+
+    def _queue_update(self, record: NamedTuple, full_path: str):
         """
-        Actualiza la ruta del recorte en la base de datos
+        Encola la actualización de la ruta de un recorte y envía el lote al llenarse
         
         Args:
-            record (Dict): Registro del recorte
+            record (NamedTuple): Registro del recorte
             full_path (str): Ruta completa donde se guardó el recorte
         """
+        self._pending.append((full_path, record.cod_barra,
+                              record.NumeroPagina, record.Field_id))
+        if len(self._pending) >= DB_BATCH_SIZE:
+            self._flush_pending_updates()
+
+    def _flush_pending_updates(self):
+        """Envía las actualizaciones pendientes; si fallan, cuenta el lote como error"""
+        if not self._pending:
+            return
+        try:
+            self.update_recorte_paths(self._pending)
+        except Exception as e:
+            self.logger.error(f"Error enviando lote de {len(self._pending)} rutas de recorte: {str(e)}")
+            self._db_errors += len(self._pending)
+            try:
+                self._conn.rollback()
+            except Exception as rollback_error:
+                self.logger.error(f"Error al revertir el lote: {str(rollback_error)}")
+        finally:
+            self._pending.clear()
+
+    def update_recorte_paths(self, updates: List[Tuple]):
+        """
+        Actualiza en lote las rutas de los recortes en la base de datos
+        
+        Args:
+            updates (List[Tuple]): Tuplas (RutaRecorte, cod_barra, NumeroPagina, Field_id)
+        """
         try:
             query = """
             UPDATE ListadoMuestraCodificacion 
@@ -133,15 +217,14 @@ class RecortesProcessor:
             AND Field_id = ?
             """
             
-            with pyodbc.connect(self.connection_string) as conn:
-                with conn.cursor() as cursor:
-                    cursor.execute(query, (full_path, record['cod_barra'], 
-                                        record['NumeroPagina'], record['Field_id']))
-                    conn.commit()
+            with self._conn.cursor() as cursor:
+                cursor.fast_executemany = True
+                cursor.executemany(query, updates)
+            self._conn.commit()
             
-            self.logger.info(f"Actualizada ruta de recorte en BD: {full_path}")
+            self.logger.info(f"Actualizadas {len(updates)} rutas de recorte en BD")
         except Exception as e:
-            self.logger.error(f"Error actualizando ruta de recorte: {str(e)}")
+            self.logger.error(f"Error actualizando rutas de recorte: {str(e)}")
             raise
 
     def setup_logging(self):
@@ -155,27 +238,51 @@ class RecortesProcessor:
             f'recortes_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
         )
         
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(log_file, encoding='utf-8'),
-                logging.StreamHandler()
-            ]
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        file_handler = logging.FileHandler(log_file, encoding='utf-8', delay=True)
+        file_handler.setFormatter(formatter)
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(formatter)
+        
+        # El archivo se escribe en bloques de 1000 registros (o de inmediato ante un error)
+        buffered_file_handler = MemoryHandler(
+            capacity=1000,
+            flushLevel=logging.ERROR,
+            target=file_handler
         )
+        
+        # Los hilos de trabajo solo encolan; un hilo aparte escribe en archivo y consola
+        log_queue = queue.Queue(-1)
+        self._log_listener = QueueListener(log_queue, buffered_file_handler, stream_handler)
+        self._log_listener.start()
+        atexit.register(self._log_listener.stop)
+        
+        # El formato completo lo aplican los handlers del listener; el QueueHandler
+        # solo debe dejar el mensaje, o el prefijo saldría duplicado
+        logging.basicConfig(level=logging.INFO, format='%(message)s', handlers=[QueueHandler(log_queue)])
         self.logger = logging.getLogger(__name__)
 
-    def get_dpi_from_image(self, image_path: str) -> Tuple[int, int]:
+    def get_dpi_from_image(self, image_path: str, data: np.ndarray = None) -> Tuple[int, int]:
         """
         Obtiene el DPI de una imagen
         
         Args:
             image_path (str): Ruta de la imagen
+            data (np.ndarray): Contenido del archivo ya leído; si se indica,
+                el encabezado TIFF se analiza en memoria sin volver a abrir el archivo
             
         Returns:
             tuple: (dpi_x, dpi_y)
         """
         try:
+            # Camino rápido: leer las etiquetas de resolución del encabezado TIFF
+            if data is not None:
+                dpi = self._read_tiff_dpi(data)
+                if dpi is not None:
+                    return dpi
+            
+            # Otros formatos o casos no contemplados: delegar en PIL, que abre el
+            # archivo de forma diferida y solo lee el encabezado (sin copiar data)
             with Image.open(image_path) as img:
                 dpi = img.info.get('dpi', (300, 300))
                 return dpi
@@ -183,34 +290,79 @@ class RecortesProcessor:
             self.logger.error(f"Error al obtener DPI de {image_path}: {str(e)}")
             return (300, 300)
 
-    def inches_to_pixels(self, inches: float, width: float = None, height: float = None, 
-                        is_coordinate: bool = False, dpi: int = 300) -> int:
+    @staticmethod
+    def _read_tiff_dpi(data: np.ndarray) -> Optional[Tuple[float, float]]:
         """
-        Convierte pulgadas a píxeles usando la misma fórmula que SQL
+        Lee XResolution/YResolution del primer IFD de un TIFF clásico con struct,
+        con la misma interpretación de ResolutionUnit que PIL
         
         Args:
-            inches (float): Medida en pulgadas
-            width (float): Ancho en pulgadas (solo necesario para coordenadas X)
-            height (float): Alto en pulgadas (solo necesario para coordenadas Y)
-            is_coordinate (bool): True si es una coordenada (x,y), False si es una dimensión
-            dpi (int): DPI de la imagen
+            data (np.ndarray): Contenido del archivo
             
         Returns:
-            int: Medida en píxeles
+            tuple: (dpi_x, dpi_y), o None si el archivo no es un TIFF clásico o
+            no trae ambas resoluciones en pulgadas o centímetros
         """
         try:
-            if is_coordinate:
-                if width is not None:  # Para coordenada X
-                    return int((float(inches) - float(width)/2) * dpi)
-                elif height is not None:  # Para coordenada Y
-                    return int((float(inches) - float(height)/2) * dpi)
-                else:
-                    raise ValueError("Se requiere width o height para convertir coordenadas")
-            else:
-                return int(float(inches) * dpi)
-        except Exception as e:
-            self.logger.error(f"Error en conversión de pulgadas a píxeles: {str(e)}")
-            raise
+            byte_order = {b'II': '<', b'MM': '>'}.get(data[:2].tobytes())
+            if byte_order is None:
+                return None
+            magic, ifd_offset = struct.unpack_from(byte_order + 'HI', data, 2)
+            if magic != 42:
+                return None
+            
+            (entries,) = struct.unpack_from(byte_order + 'H', data, ifd_offset)
+            resolution = {}
+            unit = None
+            for entry in range(ifd_offset + 2, ifd_offset + 2 + entries * 12, 12):
+                tag, field_type, count, value = struct.unpack_from(byte_order + 'HHII', data, entry)
+                if tag in (TIFF_TAG_XRESOLUTION, TIFF_TAG_YRESOLUTION) and field_type == 5 and count == 1:
+                    # RATIONAL: el valor es un desplazamiento a numerador y denominador
+                    numerator, denominator = struct.unpack_from(byte_order + 'II', data, value)
+                    if denominator:
+                        resolution[tag] = numerator / denominator
+                elif tag == TIFF_TAG_RESOLUTION_UNIT and field_type == 3 and count == 1:
+                    # SHORT: el valor va en los dos primeros bytes del campo
+                    (unit,) = struct.unpack_from(byte_order + 'H', data, entry + 8)
+            
+            x_res = resolution.get(TIFF_TAG_XRESOLUTION)
+            y_res = resolution.get(TIFF_TAG_YRESOLUTION)
+            if not x_res or not y_res:
+                return None
+            if unit in (None, 2):  # Pulgadas (valor por defecto)
+                return (x_res, y_res)
+            if unit == 3:          # Centímetros
+                return (x_res * 2.54, y_res * 2.54)
+            return None
+        except struct.error:
+            return None
+
+    def pixel_boxes(self, records: List[NamedTuple], dpi: Tuple[int, int]) -> List[Tuple[int, int, int, int]]:
+        """
+        Convierte a píxeles, en un solo paso vectorizado, el recuadro de todos
+        los registros de una imagen. La esquina superior izquierda en pulgadas
+        ya viene calculada desde SQL; aquí solo se aplica el DPI de la imagen.
+        
+        Args:
+            records (List[NamedTuple]): Registros con Cord_left, Cord_top, Cord_width y Cord_height
+            dpi (tuple): (dpi_x, dpi_y) de la imagen
+            
+        Returns:
+            list: (x, y, ancho, alto) en píxeles por registro, o None si las
+            coordenadas del registro no son válidas
+        """
+        dpi_x, dpi_y = int(dpi[0]), int(dpi[1])
+        boxes = np.array(
+            [(r.Cord_left, r.Cord_top, r.Cord_width, r.Cord_height) for r in records],
+            dtype=np.float64
+        ).reshape(-1, 4)
+        boxes *= np.array([dpi_x, dpi_y, dpi_x, dpi_y], dtype=np.float64)
+        
+        # Coordenadas nulas llegan como NaN y no se pueden convertir a entero
+        valid = np.isfinite(boxes).all(axis=1)
+        pixels = np.where(valid[:, None], boxes, 0).astype(np.int64)
+        return [tuple(box) if ok else None
+                for box, ok in zip(pixels.tolist(), valid.tolist())]
 
     def validate_image_path(self, image_path: str) -> bool:
         """
@@ -232,12 +384,12 @@ class RecortesProcessor:
             
         return True
 
-    def get_records_to_process(self) -> List[Dict]:
+    def iter_records_to_process(self) -> Iterator[NamedTuple]:
         """
-        Obtiene los registros a procesar de la base de datos
+        Obtiene los registros a procesar de la base de datos por lotes
         
-        Returns:
-            list: Lista de registros a procesar
+        Yields:
+            NamedTuple: Registro a procesar, con un campo por columna
         """
         query = """
         SELECT DISTINCT 
@@ -250,8 +402,8 @@ class RecortesProcessor:
             l.Area,
             l.cod_item,
             c.Ruta,
-            CAST(f.Cord_x AS float) as Cord_x,
-            CAST(f.Cord_y AS float) as Cord_y,
+            CAST(f.Cord_x AS float) - CAST(f.Cord_width AS float) / 2 as Cord_left,
+            CAST(f.Cord_y AS float) - CAST(f.Cord_height AS float) / 2 as Cord_top,
             CAST(f.Cord_width AS float) as Cord_width,
             CAST(f.Cord_height AS float) as Cord_height,
             c.Id as CodificacionId
@@ -259,96 +411,188 @@ class RecortesProcessor:
         INNER JOIN Codificacion c ON (c.CodigoExamen = l.cod_barra and c.NumeroPagina = l.NumeroPagina)
         INNER JOIN Tbl_Fields f ON f.ID = l.Field_id
         WHERE l.RutaRecorte IS NULL
-        ORDER BY c.Id, l.cod_barra
+        ORDER BY c.Ruta, c.Id, l.cod_barra, l.Field_id
+        OPTION (FAST 1000)
         """
         
         try:
-            with pyodbc.connect(self.connection_string) as conn:
+            # Conexión de solo lectura: en autocommit no queda una transacción
+            # implícita abierta mientras dura el procesamiento
+            with pyodbc.connect(self.connection_string, autocommit=True) as conn:
                 with conn.cursor() as cursor:
+                    cursor.arraysize = FETCH_BATCH_SIZE
                     cursor.execute(query)
                     columns = [column[0] for column in cursor.description]
-                    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+                    Record = namedtuple('Record', columns, rename=True)
+                    while True:
+                        rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+                        if not rows:
+                            break
+                        for row in rows:
+                            yield Record._make(row)
         except Exception as e:
             self.logger.error(f"Error al obtener registros: {str(e)}")
             raise
 
-    def process_image(self, record: Dict):
-        """Procesa una imagen individual"""
+    def read_image_file(self, image_path: str) -> np.ndarray:
+        """
+        Lee del disco el contenido de una imagen de origen (etapa de lectura)
+        
+        Args:
+            image_path (str): Ruta de la imagen de origen
+            
+        Returns:
+            np.ndarray: Bytes del archivo, sin decodificar
+        """
         try:
-            image_path = record['Ruta']
-            self.logger.info(f"Procesando imagen: {image_path}")
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(f"Procesando imagen: {image_path}")
             
             # Validar imagen
             if not self.validate_image_path(image_path):
                 raise ValueError(f"Imagen inválida: {image_path}")
             
+            # Leer el archivo una sola vez: DPI y píxeles salen del mismo buffer
+            return np.fromfile(image_path, dtype=np.uint8)
+            
+        except Exception as e:
+            self._handle_image_error(image_path, e)
+            raise
+
+    def decode_image(self, image_path: str, data: np.ndarray) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """
+        Obtiene el DPI y decodifica una imagen ya leída (en los hilos de trabajo)
+        
+        Args:
+            image_path (str): Ruta de la imagen de origen
+            data (np.ndarray): Bytes del archivo
+            
+        Returns:
+            tuple: (imagen, (dpi_x, dpi_y))
+        """
+        try:
             # Obtener DPI de la imagen
-            dpi = self.get_dpi_from_image(image_path)
-            self.logger.info(f"DPI de la imagen: {dpi}")
+            dpi = self.get_dpi_from_image(image_path, data)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(f"DPI de la imagen: {dpi}")
             
-            # Leer imagen con OpenCV
-            img = cv2.imread(image_path)
+            # Decodificar con OpenCV a 8 bits y con orientación EXIF, como imread;
+            # los escaneos en gris o bitonales no se expanden a BGR de 3 canales
+            img = cv2.imdecode(data, cv2.IMREAD_ANYCOLOR)
             if img is None:
                 raise ValueError(f"No se pudo cargar la imagen: {image_path}")
             
-            # Convertir coordenadas de pulgadas a píxeles
-            width = self.inches_to_pixels(float(record['Cord_width']), dpi=int(dpi[0]))
-            height = self.inches_to_pixels(float(record['Cord_height']), dpi=int(dpi[1]))
-            x = self.inches_to_pixels(float(record['Cord_x']), width=float(record['Cord_width']), 
-                                    is_coordinate=True, dpi=int(dpi[0]))
-            y = self.inches_to_pixels(float(record['Cord_y']), height=float(record['Cord_height']), 
-                                    is_coordinate=True, dpi=int(dpi[1]))
+            return img, dpi
+            
+        except Exception as e:
+            self._handle_image_error(image_path, e)
+            raise
+
+    def crop_image(self, record: NamedTuple, img: np.ndarray, dpi: Tuple[int, int],
+                   box: Tuple[int, int, int, int]) -> str:
+        """
+        Recorta y guarda el campo de un registro (etapa de recorte)
+        
+        Args:
+            record (NamedTuple): Registro del recorte
+            img (np.ndarray): Imagen de origen ya decodificada
+            dpi (tuple): (dpi_x, dpi_y) de la imagen
+            box (tuple): (x, y, ancho, alto) en píxeles, o None si no es válido
+            
+        Returns:
+            str: Ruta completa donde se guardó el recorte
+        """
+        try:
+            image_path = record.Ruta
+            
+            if box is None:
+                raise ValueError(f"Coordenadas inválidas para el campo {record.Field_id}")
+            dpi_x, dpi_y = int(dpi[0]), int(dpi[1])
+            x, y, width, height = box
             
             # Realizar el recorte
             crop = img[y:y+height, x:x+width]
             
             # Crear estructura de directorios y obtener ruta completa
             output_path = self.create_hierarchical_directories(record)
-            output_path = self.normalize_path(output_path)
-            
-            # Verificar permisos antes de guardar
-            output_dir = os.path.dirname(output_path)
-            if not os.access(output_dir, os.W_OK):
-                self.logger.warning(f"Verificando permisos en directorio: {output_dir}")
-                try:
-                    os.makedirs(output_dir, exist_ok=True)
-                except Exception as e:
-                    raise ValueError(f"No se pueden crear/acceder los directorios: {str(e)}")
             
             # Guardar como TIFF
-            success = cv2.imwrite(
-                output_path,
-                crop,
-                [
-                    cv2.IMWRITE_TIFF_COMPRESSION, 5,  # Sin compresión
-                    cv2.IMWRITE_TIFF_RESUNIT, 2,     # Pulgadas
-                    cv2.IMWRITE_TIFF_XDPI, int(dpi[0]),   # DPI X
-                    cv2.IMWRITE_TIFF_YDPI, int(dpi[1])    # DPI Y
-                ]
-            )
-            
-            if not success:
-                self.logger.warning(f"Intentando guardar con PIL...")
-                pil_image = Image.fromarray(cv2.cvtColor(crop, cv2.COLOR_BGR2RGB))
-                pil_image.save(output_path, 'TIFF', dpi=dpi)
+            tiff_params = [
+                cv2.IMWRITE_TIFF_COMPRESSION, 5,  # LZW (sin pérdida)
+                cv2.IMWRITE_TIFF_RESUNIT, 2,     # Pulgadas
+                cv2.IMWRITE_TIFF_XDPI, dpi_x,    # DPI X
+                cv2.IMWRITE_TIFF_YDPI, dpi_y     # DPI Y
+            ]
             
-            # Verificar que el archivo se creó correctamente
-            if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
-                raise ValueError(f"El archivo de salida no se creó correctamente: {output_path}")
+            # Codificar en memoria y escribir con una sola llamada al sistema,
+            # sin el búfer intermedio de stdio de cv2.imwrite
+            encoded, buffer = cv2.imencode('.tif', crop, tiff_params)
+            if not encoded or buffer.size == 0:
+                raise ValueError(f"No se pudo codificar el recorte: {output_path}")
+            self._write_file(output_path, buffer)
             
-            # Actualizar la ruta en la base de datos
-            self.update_recorte_path(record, output_path)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(f"Recorte guardado exitosamente: {output_path}")
+                self.logger.debug(f"Dimensiones del recorte: {width}x{height} píxeles")
             
-            self.logger.info(f"Recorte guardado exitosamente: {output_path}")
-            self.logger.debug(f"Dimensiones del recorte: {width}x{height} píxeles")
+            return output_path
             
         except Exception as e:
-            error_msg = f"Error procesando imagen {image_path}: {str(e)}"
-            self.logger.error(error_msg)
-            self.logger.error(traceback.format_exc())
-            self.backup_failed_image(image_path, error_msg)
+            self._handle_image_error(image_path, e)
             raise
 
+    @staticmethod
+    def _write_file(path: str, buffer: np.ndarray):
+        """
+        Escribe un búfer en disco directamente con os.write
+        
+        Args:
+            path (str): Ruta del archivo de salida
+            buffer (np.ndarray): Contenido a escribir
+        """
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+        fd = os.open(path, flags, 0o644)
+        try:
+            view = memoryview(buffer.reshape(-1))
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
+    def process_image_group(self, records: List[NamedTuple], image_path: str,
+                            data: np.ndarray) -> List[Tuple[NamedTuple, str, Exception]]:
+        """
+        Decodifica una imagen de origen y genera todos sus recortes
+        
+        Args:
+            records (List[NamedTuple]): Registros que comparten la misma imagen de origen
+            image_path (str): Ruta de la imagen de origen
+            data (np.ndarray): Bytes del archivo leídos por la etapa de lectura
+            
+        Returns:
+            list: Tuplas (registro, ruta del recorte, excepción o None)
+        """
+        try:
+            img, dpi = self.decode_image(image_path, data)
+            boxes = self.pixel_boxes(records, dpi)
+        except Exception as e:
+            return [(record, None, e) for record in records]
+        
+        outcomes = []
+        for record, box in zip(records, boxes):
+            try:
+                outcomes.append((record, self.crop_image(record, img, dpi, box), None))
+            except Exception as e:
+                outcomes.append((record, None, e))
+        return outcomes
+
+    def _handle_image_error(self, image_path: str, error: Exception):
+        """Registra el error de una imagen y guarda una copia de respaldo"""
+        error_msg = f"Error procesando imagen {image_path}: {str(error)}"
+        self.logger.error(error_msg)
+        self.logger.error(traceback.format_exc())
+        self.backup_failed_image(image_path, error_msg)
+
     def backup_failed_image(self, image_path: str, error_info: str):
         """
         Guarda una copia de la imagen que falló junto con información del error
@@ -379,30 +623,139 @@ class RecortesProcessor:
         except Exception as e:
             self.logger.error(f"Error al hacer backup de imagen fallida: {str(e)}")
 
+    def _read_stage(self, records: Iterator[NamedTuple], read_queue: queue.Queue):
+        """
+        Etapa 1: agrupa los registros por imagen de origen, lee cada archivo una
+        sola vez y deja el grupo en la cola de trabajo. Las lecturas de las
+        próximas imágenes se lanzan por adelantado para mantener ocupado el disco.
+        
+        Args:
+            records (Iterator[NamedTuple]): Registros a procesar, ordenados por Ruta
+            read_queue (queue.Queue): Cola de salida con tuplas (registros, ruta, bytes, error)
+        """
+        try:
+            with ThreadPoolExecutor(max_workers=READ_AHEAD) as readers:
+                ahead = deque()
+                for image_path, group in groupby(records, key=attrgetter('Ruta')):
+                    future = readers.submit(self.read_image_file, image_path)
+                    ahead.append((list(group), image_path, future))
+                    if len(ahead) >= READ_AHEAD:
+                        self._put_read_result(read_queue, *ahead.popleft())
+                while ahead:
+                    self._put_read_result(read_queue, *ahead.popleft())
+        except Exception as e:
+            self._pipeline_error = e
+        finally:
+            read_queue.put(None)
+
+    @staticmethod
+    def _put_read_result(read_queue: queue.Queue, group: List[NamedTuple], image_path: str, future):
+        """Espera la lectura de una imagen y la deja en la cola en el orden original"""
+        try:
+            read_queue.put((group, image_path, future.result(), None))
+        except Exception as e:
+            read_queue.put((group, image_path, None, e))
+
+    def _crop_stage(self, read_queue: queue.Queue) -> Iterator[Tuple[NamedTuple, str, Exception]]:
+        """
+        Etapa 2: un pool de hilos decodifica cada imagen y guarda sus recortes,
+        manteniendo acotado el número de imágenes en vuelo
+        
+        Args:
+            read_queue (queue.Queue): Cola con las imágenes leídas
+            
+        Yields:
+            tuple: (registro, ruta del recorte, excepción o None)
+        """
+        max_pending = MAX_WORKERS * 2
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            pending = set()
+            for group, image_path, data, error in iter(read_queue.get, None):
+                if error is not None:
+                    for record in group:
+                        yield record, None, error
+                    continue
+                pending.add(executor.submit(self.process_image_group, group, image_path, data))
+                if len(pending) < max_pending:
+                    continue
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+            
+            for future in pending:
+                yield from future.result()
+
+    def _db_stage(self, db_queue: queue.Queue):
+        """
+        Etapa 3: acumula las rutas de recorte y las actualiza en lotes
+        
+        Args:
+            db_queue (queue.Queue): Cola con tuplas (registro, ruta del recorte)
+        """
+        queue_finished = False
+        try:
+            for record, full_path in iter(db_queue.get, None):
+                self._queue_update(record, full_path)
+            queue_finished = True
+            self._flush_pending_updates()
+        except Exception as e:
+            self.logger.error(f"Error en la etapa de actualización de BD: {str(e)}")
+            # Lo pendiente no se registró; descartar el resto de la cola para no
+            # bloquear a las otras etapas
+            self._db_errors += len(self._pending)
+            self._pending.clear()
+            if not queue_finished:
+                for update in iter(db_queue.get, None):
+                    self._db_errors += 1
+
     def process_all(self):
         """Procesa todos los recortes pendientes"""
         try:
             self.logger.info("Iniciando procesamiento de recortes")
-            records = self.get_records_to_process()
-            total_records = len(records)
-            self.logger.info(f"Se encontraron {total_records} recortes para procesar")
-            
             processed = 0
             errors = 0
             skipped = 0
             
-            for record in records:
-                try:
-                    self.process_image(record)
-                    processed += 1
-                    if processed % 10 == 0:
-                        self.logger.info(f"Progreso: {processed}/{total_records} ({(processed/total_records)*100:.1f}%)")
-                except Exception as e:
-                    errors += 1
-                    self.logger.error(f"Error procesando registro {record.get('cod_barra', 'desconocido')}: {str(e)}")
-                    continue
+            # Pipeline de tres etapas: lectura -> recorte/guardado -> actualización en BD.
+            # Las colas acotadas dan contrapresión entre etapas.
+            self._pipeline_error = None
+            self._db_errors = 0
+            read_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+            db_queue = queue.Queue(maxsize=DB_BATCH_SIZE * 2)
+            
+            # Los registros llegan por lotes; el procesamiento empieza con el primer lote
+            reader = threading.Thread(
+                target=self._read_stage,
+                args=(self.iter_records_to_process(), read_queue),
+                daemon=True
+            )
+            db_writer = threading.Thread(target=self._db_stage, args=(db_queue,), daemon=True)
+            reader.start()
+            db_writer.start()
+            
+            try:
+                for record, output_path, error in self._crop_stage(read_queue):
+                    if error is None:
+                        db_queue.put((record, output_path))
+                        processed += 1
+                        if processed % 100 == 0:
+                            self.logger.info(f"Progreso: {processed} recortes procesados")
+                    else:
+                        errors += 1
+                        self.logger.error(f"Error procesando registro {getattr(record, 'cod_barra', 'desconocido')}: {str(error)}")
+            finally:
+                db_queue.put(None)
+                db_writer.join()
+            
+            if self._pipeline_error is not None:
+                raise self._pipeline_error
+            
+            # Los recortes cuya ruta no se pudo registrar en BD cuentan como error
+            processed -= self._db_errors
+            errors += self._db_errors
             
             # Resumen final
+            total_records = processed + errors + skipped
             self.logger.info("=== Resumen del Procesamiento ===")
             self.logger.info(f"Total de recortes: {total_records}")
             self.logger.info(f"Procesados exitosamente: {processed}")
@@ -425,7 +778,10 @@ def main():
         
         # Crear y ejecutar el procesador
         processor = RecortesProcessor(SQLSERVER_CONFIG, output_directory)
-        processor.process_all()
+        try:
+            processor.process_all()
+        finally:
+            processor.close()
         
         return 0
         